@@ -1,17 +1,24 @@
 import os
+from itertools import islice
 from pathlib import Path
 import shutil
 import duckdb
+import numpy as np
 import pandas as pd
 import kagglehub as kg
 from neo4j import GraphDatabase
 from halo import Halo
 
 
-def query_memgraph_cycles(uri="bolt://localhost:7687"):
+def query_memgraph_cycles(uri="bolt://localhost:7687", source_file="/data/SAML-D.csv"):
     """
     Uses Memgraph's built-in simple cycle detector to find structural cycles and 
     rotates them to find valid chronological money flows.
+
+    source_file is the CSV path as seen from inside the Memgraph container. Cycles
+    are yielded one record at a time as Memgraph streams them back, so callers
+    never hold the full result set in memory. A failure part way through the
+    stream is re-raised so callers can discard the partial result.
     """
     load_spinner = Halo(text="Loading data and indexes into Memgraoh...",
                         color="cyan", spinner="dots")
@@ -27,19 +34,19 @@ def query_memgraph_cycles(uri="bolt://localhost:7687"):
     STORAGE MODE IN_MEMORY_ANALYTICAL;
     """
 
-    load_data_query = """
-    LOAD CSV FROM "/data/SAML-D.csv" WITH HEADER AS row
-    MERGE (s:Account {accountID: toInteger(row.Sender_account)})
+    load_data_query = f"""
+    LOAD CSV FROM "{source_file}" WITH HEADER AS row
+    MERGE (s:Account {{accountID: toInteger(row.Sender_account)}})
     SET s:Sender
-    MERGE (r:Account {accountID: toInteger(row.Receiver_account)})
+    MERGE (r:Account {{accountID: toInteger(row.Receiver_account)}})
     SET r:Receiver
 
     // Create a direct relationship instead of a node
-    MERGE (s)-[:TRANSFERRED {
+    MERGE (s)-[:TRANSFERRED {{
         amount: toFloat(row.Amount),
         datetime: datetime(row.Date+"T"+row.Time),
         type: row.Laundering_type
-    }]->(r);
+    }}]->(r);
     """
 
     cycle_query = """
@@ -73,6 +80,7 @@ def query_memgraph_cycles(uri="bolt://localhost:7687"):
            [k in range(0, size(edges)-1) | edges[(s + k) % size(edges)].datetime] AS hoptimes
     """
 
+    driver = None
     try:
         driver = GraphDatabase.driver(uri, auth=("", ""))
         with driver.session() as session:
@@ -80,56 +88,217 @@ def query_memgraph_cycles(uri="bolt://localhost:7687"):
             session.run(set_mode_query)
             session.run(load_data_query)
             load_spinner.succeed(
-                "Loaded 855K nodes and 9.5M edges into Memgraph.")
+                f"Loaded {source_file} into Memgraph.")
             cycle_spinner.start()
-            result = session.run(cycle_query)
-            records = [dict(record) for record in result]
-        driver.close()
+            cycle_count = 0
+            for record in session.run(cycle_query):
+                cycle_count += 1
+                yield dict(record)
         cycle_spinner.succeed(
-            f"Detected {len(records)} temporal cycles via Memgraph.")
-        return records
+            f"Detected {cycle_count} temporal cycles via Memgraph.")
     except Exception as e:
         cycle_spinner.fail(f"Memgraph Connection Failed: {e}")
-        return []
+        raise
+    finally:
+        # Also runs when the consumer stops iterating early
+        if driver is not None:
+            driver.close()
 
 
-def write_memgraph_results_to_csv(records, output_filepath='./data/detected_cycles.csv'):
+def flatten_cycle_records(records):
+    """
+    Flattens a batch of graph records into a DataFrame with one row per hop.
     """
-    Flattens the graph records into a transactional CSV for reporting.
+    # Explode the per-cycle lists into one row per hop in a single pass; each
+    # hop's receiver is the next hop's sender, wrapping back to the cycle start
+    df = pd.DataFrame(records).explode(['account_path', 'amounts', 'hoptimes'],
+                                       ignore_index=True)
+    lengths = np.fromiter((len(rec['account_path']) for rec in records),
+                          dtype=np.int64, count=len(records))
+    ends = np.cumsum(lengths)
+    starts = ends - lengths
+    next_hop = np.arange(1, len(df) + 1)
+    next_hop[ends - 1] = starts
+    senders = df['account_path'].to_numpy(dtype=np.int64)
+
+    df = pd.DataFrame({
+        'Cycle_ID': df['cycle_id'],
+        'Sender_account': senders,
+        'Receiver_account': senders[next_hop],
+        'Amount': df['amounts'].astype(np.float64),
+        # Memgraph/Neo4j datetime objects are written in their ISO form
+        'Timestamp': df['hoptimes'].astype(str),
+        'Hop_Number': np.arange(len(df)) - np.repeat(starts, lengths) + 1,
+        'Cycle_Length': np.repeat(lengths, lengths)
+    })
+    return df
+
+
+def write_memgraph_results_to_csv(conn: duckdb.DuckDBPyConnection, records,
+                                  output_filepath='./data/detected_cycles.csv',
+                                  batch_size=10_000):
     """
-    if not records:
+    Flattens the graph records into a transactional CSV for reporting. Records are
+    consumed in batches and staged in a DuckDB table, so only one batch is resident
+    in Python at a time, and DuckDB's COPY handles the CSV serialization. If the
+    record stream fails, the staged batches are dropped and output_filepath is left
+    untouched.
+    """
+    conn.execute("""
+    CREATE OR REPLACE TEMP TABLE cycles (
+        Cycle_ID BIGINT,
+        Sender_account BIGINT,
+        Receiver_account BIGINT,
+        Amount DOUBLE,
+        Timestamp VARCHAR,
+        Hop_Number BIGINT,
+        Cycle_Length BIGINT
+    );
+    """)
+
+    records = iter(records)
+    row_count = 0
+    while True:
+        # Only a failing record stream is handled here; flatten/insert errors are bugs and propagate
+        try:
+            batch = list(islice(records, batch_size))
+        except Exception as e:
+            conn.execute("DROP TABLE cycles;")
+            print(f"Cycle export aborted, '{output_filepath}' left unchanged: {e}")
+            return
+        if not batch:
+            break
+
+        conn.register('cycles_df', flatten_cycle_records(batch))
+        conn.execute("INSERT INTO cycles SELECT * FROM cycles_df;")
+        conn.unregister('cycles_df')
+        row_count += sum(len(rec['account_path']) for rec in batch)
+
+    if row_count:
+        conn.execute(
+            f"COPY (SELECT * FROM cycles ORDER BY Cycle_ID, Hop_Number) "
+            f"TO '{output_filepath}' (HEADER, DELIMITER ',');")
+        print(
+            f"✅ Successfully wrote {row_count} transactions to '{output_filepath}'")
+    else:
         print("No cycles to export.")
-        return
-
-    flattened = []
-    for rec in records:
-        c_id = rec['cycle_id']
-        path = rec['account_path']
-        amts = rec['amounts']
-        times = rec['hoptimes']
-
-        for i in range(len(path)):
-            # Handle Memgraph/Neo4j datetime objects or dicts
-            ts = times[i]
-
-            flattened.append({
-                'Cycle_ID': c_id,
-                'Sender_account': path[i],
-                'Receiver_account': path[(i + 1) % len(path)],
-                'Amount': amts[i],
-                'Timestamp': ts,
-                'Hop_Number': i + 1,
-                'Cycle_Length': len(path)
-            })
-
-    df = pd.DataFrame(flattened)
-    df.to_csv(output_filepath, index=False)
-    print(
-        f"✅ Successfully wrote {len(df)} transactions to '{output_filepath}'")
+    conn.execute("DROP TABLE cycles;")
+
+
+def configure_duckdb(conn: duckdb.DuckDBPyConnection,
+                     threads: int = 0,
+                     memory_limit: str = "8GB",
+                     temp_directory: str = "./duckdb_tmp"):
+    """
+    Applies explicit DuckDB settings so aggregations run on every core and spill to disk instead of running out of
+    memory on the full dataset.
+
+    Parameters:
+    1. conn (DuckDBPyConnection): Connection object to DuckDB.
+    2. threads (int): Number of threads DuckDB may use; 0 uses every available core.
+    3. memory_limit (str): Cap on DuckDB's memory usage. Kept below the 16 GB minimum since Memgraph shares the machine.
+    4. temp_directory (str): Directory DuckDB spills to once memory_limit is reached.
+
+    """
+    threads = threads or os.cpu_count() or 1
+    conn.execute(f"SET threads TO {threads};")
+    conn.execute(f"SET memory_limit = '{memory_limit}';")
+    conn.execute(f"SET temp_directory = '{temp_directory}';")
+    # Every export that needs a specific row order has an explicit ORDER BY
+    conn.execute("SET preserve_insertion_order = false;")
+
+
+def load_transactions(conn: duckdb.DuckDBPyConnection,
+                      source_file: str = "./data/SAML-D.csv",
+                      table_name: str = "tx"):
+    """
+    Parses the source CSV once into a DuckDB table so that every downstream query scans the in-memory table
+    instead of re-reading and re-parsing the CSV.
+
+    Parameters:
+    1. conn (DuckDBPyConnection): Connection object to DuckDB.
+    2. source_file (str): Path to the source dataset.
+    3. table_name (str): Name of the table the dataset is loaded into.
+
+    """
+
+    spinner = Halo(text="Loading transactions from CSV into DuckDB...",
+                   color="magenta", spinner="dots2")
+    spinner.start()
+
+    conn.execute(
+        f"CREATE OR REPLACE TABLE {table_name} AS SELECT * FROM read_csv_auto('{source_file}');")
+
+    spinner.succeed(f"Loaded {source_file} into table '{table_name}'")
+
+
+def export_cycle_candidates(conn: duckdb.DuckDBPyConnection,
+                            source_table: str = "tx",
+                            output_filepath: str = "./data/cycle_candidates.csv",
+                            max_rounds: int = 10):
+    """
+    Docstring for export_cycle_candidates
+    Every account on a cycle both sends and receives money, so a transaction can only be part of a cycle if its sender
+    also appears as a receiver and its receiver also appears as a sender. Dropping such transactions can strip other
+    accounts of their last incoming or outgoing transaction, so the filter is repeated on the remainder until nothing
+    more is removed, up to max_rounds rounds. The surviving transactions are exported for Memgraph to load, shrinking
+    the graph handed to the cycle detector.
+
+    Parameters:
+    1. conn (DuckDBPyConnection): Connection object to DuckDB.
+    2. source_table (str): DuckDB table holding the source dataset, see load_transactions.
+    3. output_filepath (str): Path where the candidate transactions should be stored.
+    4. max_rounds (int): Upper bound on the number of pruning rounds, at least 1; the spinner reports when it is hit
+                         before the pruning converges.
+
+    """
+
+    if max_rounds < 1:
+        raise ValueError(f"max_rounds must be at least 1, got {max_rounds}")
+
+    spinner = Halo(text="Pruning accounts that cannot be part of a cycle...",
+                   color="magenta", spinner="dots2")
+    spinner.start()
+
+    row_count = conn.execute(
+        f"SELECT COUNT(*) FROM {source_table};").fetchone()[0]
+
+    # Peel off transactions touching a receive-only or send-only account, one layer per round;
+    # the first round reads the source table directly so it is never copied unpruned
+    prune_query = \
+        """
+        CREATE OR REPLACE TEMP TABLE cycle_candidates AS
+        SELECT *
+        FROM {table}
+        WHERE Sender_account IN (SELECT Receiver_account FROM {table})
+        AND Receiver_account IN (SELECT Sender_account FROM {table});
+        """
+
+    converged = False
+    for round_number in range(max_rounds):
+        conn.execute(prune_query.format(
+            table=source_table if round_number == 0 else "cycle_candidates"))
+        pruned_count = conn.execute(
+            "SELECT COUNT(*) FROM cycle_candidates;").fetchone()[0]
+        converged = pruned_count == row_count
+        row_count = pruned_count
+        if converged:
+            break
+
+    conn.execute(
+        f"COPY cycle_candidates TO '{output_filepath}' (HEADER, DELIMITER ',');")
+    conn.execute("DROP TABLE cycle_candidates;")
+
+    message = f"{row_count} cycle candidate transactions saved to {output_filepath}"
+    if converged:
+        spinner.succeed(message)
+    else:
+        spinner.warn(
+            f"{message} (stopped after {max_rounds} rounds without converging)")
 
 
 def detect_smurfing_suspects(conn: duckdb.DuckDBPyConnection,
-                             source_file: str = "./data/SAML-D.csv",
+                             source_table: str = "tx",
                              output_filepath: str = "./data/smurfing_suspects.csv",
                              preferred_sender_currency: str = "UK pounds",
                              preferred_receiver_currency: str = "UK pounds",
@@ -144,7 +313,7 @@ def detect_smurfing_suspects(conn: duckdb.DuckDBPyConnection,
 
     Parameters:
     1. conn (DuckDBPyConnection): Connection object to DuckDB.
-    2. source_file (str): Path to the source dataset.
+    2. source_table (str): DuckDB table holding the source dataset, see load_transactions.
     3. output_filepath: Path where the processed data should be stored.
     4. preferred_sender_currency (str): Preferred value for the Payment_currency column in the dataset.
     5. preferred_receiver_currency (str): Preferred value for the Received_currency column in the dataset.
@@ -156,18 +325,37 @@ def detect_smurfing_suspects(conn: duckdb.DuckDBPyConnection,
 
     """
 
-    spinner = Halo(text="Retrieving and processing data from CSV...",
+    spinner = Halo(text="Retrieving and processing transaction data...",
                    color="magenta", spinner="dots2")
     spinner.start()
 
-    # Retrieve all necessary transaction data from csv in an aggregated form with necessary filters,
-    # then self-join to get per transaction data, and finally save it to the desired location
+    # Filter the table to the preferred currencies once, aggregate the filtered rows per receiver (computing the
+    # duration a single time), then join the aggregate back to get per transaction data, and finally save it to
+    # the desired location
     full_data_query = \
         f"""
         COPY (
-            SELECT 
+            WITH filtered AS (
+                SELECT *
+                FROM {source_table}
+                WHERE Payment_currency = '{preferred_sender_currency}'
+                AND Received_currency = '{preferred_receiver_currency}'
+            ),
+            agg AS (
+                SELECT
+                    Receiver_account,
+                    SUM(Amount) AS Total_amount,
+                    COUNT(DISTINCT Sender_account) AS Sender_count,
+                    DATE_DIFF('minute', MIN(Date + Time), MAX(Date + Time)) AS Duration_Minutes
+                FROM filtered
+                GROUP BY Receiver_account
+                HAVING Sender_count > {target_minimum_distinct_senders}
+                AND Duration_Minutes <= {target_minutes_duration}
+                AND Total_amount > {target_total_threshold}
+            )
+            SELECT
                 origin.Receiver_account,
-                (DATE_DIFF('minute', agg.start_time, agg.end_time) / 1440.0) AS Duration_Days,
+                (agg.Duration_Minutes / 1440.0) AS Duration_Days,
                 origin.Date,
                 origin.Time,
                 agg.Total_amount,
@@ -178,24 +366,8 @@ def detect_smurfing_suspects(conn: duckdb.DuckDBPyConnection,
                 origin.Amount,
                 origin.Laundering_type,
                 origin.Payment_type
-            FROM '{source_file}' AS origin
-            INNER JOIN (
-                SELECT 
-                    Receiver_account, 
-                    SUM(Amount) AS Total_amount,
-                    COUNT(DISTINCT Sender_account) AS Sender_count,
-                    MIN(CAST(Date || ' ' || Time AS TIMESTAMP)) AS start_time,
-                    MAX(CAST(Date || ' ' || Time AS TIMESTAMP)) AS end_time
-                FROM '{source_file}'
-                WHERE Payment_currency = '{preferred_sender_currency}' 
-                AND Received_currency = '{preferred_receiver_currency}'
-                GROUP BY Receiver_account
-                HAVING Sender_count > {target_minimum_distinct_senders} 
-                AND DATE_DIFF('minute', start_time, end_time) <= {target_minutes_duration} 
-                AND Total_amount > {target_total_threshold}
-            ) AS agg ON origin.Receiver_account = agg.Receiver_account
-            WHERE origin.Payment_currency = '{preferred_sender_currency}' 
-            AND origin.Received_currency = '{preferred_receiver_currency}'
+            FROM filtered AS origin
+            INNER JOIN agg ON origin.Receiver_account = agg.Receiver_account
             ORDER BY origin.Receiver_account ASC, agg.Total_amount DESC
         ) TO '{output_filepath}' (HEADER, DELIMITER ',');
         """
@@ -223,15 +395,24 @@ if __name__ == "__main__":
             "berkanoztas/synthetic-transaction-monitoring-dataset-aml")
         shutil.move(os.path.join(path, 'SAML-D.csv'), './data')
 
-    # 2. Cycle Detection (Memgraph)
-    # This replaces the Python DFS entirely
-    cycle_records = query_memgraph_cycles()
-    write_memgraph_results_to_csv(cycle_records)
+    # Parse the CSV once; every DuckDB query below reads the table
+    conn = duckdb.connect()
+    configure_duckdb(conn)
+    load_transactions(conn)
 
-    # 3. Smurfing Analysis (DuckDB)
+    # 2. Smurfing Analysis (DuckDB)
     # Using unified Date + Time logic
-    conn = duckdb.connect()
     detect_smurfing_suspects(conn)
+
+    # 3. Cycle Detection (Memgraph)
+    # This replaces the Python DFS entirely; only transactions that can lie on a
+    # cycle are loaded, ./data is mounted at /data in the Memgraph container.
+    # The tx table is dropped first so DuckDB does not hold the full dataset in
+    # memory alongside Memgraph's graph
+    export_cycle_candidates(conn)
+    conn.execute("DROP TABLE tx;")
+    cycle_records = query_memgraph_cycles(source_file="/data/cycle_candidates.csv")
+    write_memgraph_results_to_csv(conn, cycle_records)
     conn.close()
 
     print("\nPipeline Complete. All patterns verified and exported.")
@@ -0,0 +1,17 @@
+
+// Data loaders
+
+// Loads only the pruned transactions; cycle_candidates.csv is generated by export_cycle_candidates in
+// data_pattern_scanner.py, see the README. data_load_from_csv.cypher loads the full dataset instead.
+LOAD CSV FROM "/data/cycle_candidates.csv" WITH HEADER AS row
+MERGE (s:Account {accountID: toInteger(row.Sender_account)})
+SET s:Sender
+MERGE (r:Account {accountID: toInteger(row.Receiver_account)})
+SET r:Receiver
+
+// Create a direct relationship instead of a node
+CREATE (s)-[:TRANSFERRED {
+    amount: toFloat(row.Amount),
+    datetime: datetime(row.Date+"T"+row.Time),
+    type: row.Laundering_type
+}]->(r);
\ No newline at end of file